@@ -0,0 +1,445 @@
+# Copyright (c) 2024, Stefan Jakobsson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# (1) Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Content-addressed package store
+#
+# Store folder layout:
+#
+#   blobs/<sha256>-<crc16>      One file per unique BLOB
+#   manifests/<name>.hdr        Package header followed by the SHA-256
+#                               digest (32 bytes) of each BLOB, in the
+#                               order of the header envelopes
+#   cache/<name>.pkg            Recently materialised package files, hard
+#                               linked to the destination on a cache hit
+#
+# A package file is rebuilt by writing the stored header and then
+# concatenating the BLOB files listed in the manifest.
+
+# Python Standard Libraries
+import os
+import sys
+import binascii
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+PKG_MAGIC_V1 = bytes([0xd8, 0x31, 0x36, 0xd0, 0xcb, 0xc7])   # "X16PKG"
+PKG_MAGIC_V2 = bytes([0x58, 0x31, 0x36, 0x50, 0x4b, 0x47])   # "x16pkg"
+HEADER_FIX_SIZE = 103
+HEADER_CRC_SIZE = 2
+BLOB_ENTRY_SIZE = 16
+DIGEST_SIZE = 32
+CHUNK_SIZE = 0x10000
+CACHE_SIZE = 8
+
+def crc16_update(crc, ba):
+    # Same CRC-16 as x16pkg.crc16, without needing intelhex
+    return binascii.crc_hqx(ba, crc)
+
+def file_concat(dst, src):
+    src = open(src, "rb")
+    ba = src.read(CHUNK_SIZE)
+    while ba:
+        dst.write(ba)
+        ba = src.read(CHUNK_SIZE)
+    src.close()
+
+def file_remove(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+def header_size(blob_count):
+    return HEADER_FIX_SIZE + BLOB_ENTRY_SIZE * blob_count + HEADER_CRC_SIZE
+
+def header_blob_count(header):
+    return header[0x65] + header[0x66] * 256
+
+def header_envelopes(header):
+    # Returns list of [type, size, crc] for each BLOB envelope
+    envelopes = []
+    for i in range(header_blob_count(header)):
+        e = HEADER_FIX_SIZE + i * BLOB_ENTRY_SIZE
+        size = header[e+4] + (header[e+5] << 8) + (header[e+6] << 16)
+        crc = header[e+7] + (header[e+8] << 8)
+        envelopes.append([header[e], size, crc])
+    return envelopes
+
+def package_size(header):
+    size = len(header)
+    for e in header_envelopes(header):
+        size += e[1]
+    return size
+
+def blob_name(digest, crc):
+    return digest.hex() + "-" + format(crc, "04x")
+
+def name_valid(name):
+    return len(name) > 0 and name != "." and name != ".." and name == os.path.basename(name)
+
+def read_header(f):
+    # Returns header bytes, or None if not a valid package header
+    header = f.read(HEADER_FIX_SIZE)
+    if len(header) < HEADER_FIX_SIZE:
+        return None
+    if header[0:6] != PKG_MAGIC_V2 and header[0:6] != PKG_MAGIC_V1:
+        return None
+
+    blob_count = header_blob_count(header)
+    rest = header_size(blob_count) - HEADER_FIX_SIZE
+    header += f.read(rest)
+    if len(header) < header_size(blob_count):
+        return None
+
+    crc = crc16_update(0xffff, header[0:-HEADER_CRC_SIZE])
+    if header[-2] != (crc & 255) or header[-1] != (crc >> 8):
+        return None
+    return header
+
+class PkgStore:
+    def __init__(self, store_dir, cache_size=CACHE_SIZE):
+        self.store_dir = store_dir
+        self.blob_dir = os.path.join(store_dir, "blobs")
+        self.manifest_dir = os.path.join(store_dir, "manifests")
+        self.cache_dir = os.path.join(store_dir, "cache")
+        self.cache_size = cache_size
+
+        # Mode for new files, as open() would create them
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Restore LRU order of cached packages, least recently used first
+        self.cache = OrderedDict()
+        cached = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(".pkg"):
+                cached.append([os.stat(os.path.join(self.cache_dir, f)).st_mtime, f[0:-4]])
+        cached.sort()
+        for c in cached:
+            self.cache[c[1]] = True
+        self.cache_evict()
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, name + ".hdr")
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, name + ".pkg")
+
+    def in_store(self, path):
+        store = os.path.realpath(self.store_dir)
+        path = os.path.realpath(path)
+        try:
+            return os.path.commonpath([store, path]) == store
+        except ValueError:
+            # Different drives on Windows
+            return False
+
+    def temp_path(self, dir):
+        fd, path = tempfile.mkstemp(suffix=".tmp", dir=dir)
+        os.close(fd)
+        os.chmod(path, self.file_mode)
+        return path
+
+    def read_manifest(self, name):
+        # Returns [header, digests], or None if the manifest is invalid
+        f = open(self.manifest_path(name), "rb")
+        header = read_header(f)
+        digests = f.read()
+        f.close()
+        if header == None or len(digests) != DIGEST_SIZE * header_blob_count(header):
+            return None
+        return [header, digests]
+
+    def list(self):
+        names = []
+        for f in os.listdir(self.manifest_dir):
+            if f.endswith(".hdr"):
+                names.append(f[0:-4])
+        names.sort()
+        return names
+
+    def ingest(self, pkg_path, name=None, replace=False):
+        # Package name defaults to file name without extension
+        if name == None:
+            name = os.path.splitext(os.path.basename(pkg_path))[0]
+        if not name_valid(name):
+            return [1, "Invalid package name"]
+
+        try:
+            src = open(pkg_path, "rb")
+        except OSError:
+            return [1, "File not found"]
+
+        header = read_header(src)
+        if header == None:
+            src.close()
+            return [1, "Invalid package header"]
+
+        # Never overwrite a different package stored under the same name
+        if not replace and os.path.isfile(self.manifest_path(name)):
+            m = self.read_manifest(name)
+            if m == None or m[0] != header:
+                src.close()
+                return [1, "Package already stored"]
+
+        # Verify all BLOBs before committing any of them to the store
+        blobs = []
+        for e in header_envelopes(header):
+            sha = hashlib.sha256()
+            crc = 0xffff
+            remaining = e[1]
+            tmp_path = self.temp_path(self.blob_dir)
+            blobs.append([tmp_path, None])
+            tmp = open(tmp_path, "wb")
+            while remaining > 0:
+                ba = src.read(min(remaining, CHUNK_SIZE))
+                if not ba:
+                    break
+                sha.update(ba)
+                crc = crc16_update(crc, ba)
+                tmp.write(ba)
+                remaining -= len(ba)
+            tmp.close()
+
+            r = None
+            if remaining > 0:
+                r = [1, "Package file truncated"]
+            elif crc != e[2]:
+                r = [1, "BLOB CRC mismatch"]
+            if r != None:
+                src.close()
+                for b in blobs:
+                    file_remove(b[0])
+                return r
+
+            blobs[-1][1] = sha.digest()
+
+        # Trailing data would not survive a rebuild
+        trailing = src.read(1)
+        src.close()
+        if trailing:
+            for b in blobs:
+                file_remove(b[0])
+            return [1, "Unexpected data after last BLOB"]
+
+        # Store each BLOB once, keyed by SHA-256 and CRC-16
+        envelopes = header_envelopes(header)
+        digests = bytearray()
+        for i in range(len(blobs)):
+            blob_path = os.path.join(self.blob_dir, blob_name(blobs[i][1], envelopes[i][2]))
+            if os.path.isfile(blob_path):
+                os.remove(blobs[i][0])
+            else:
+                os.replace(blobs[i][0], blob_path)
+            digests += blobs[i][1]
+
+        tmp_path = self.temp_path(self.manifest_dir)
+        f = open(tmp_path, "wb")
+        f.write(header)
+        f.write(digests)
+        f.close()
+        os.replace(tmp_path, self.manifest_path(name))
+
+        # Drop stale cached copy
+        if name in self.cache:
+            del self.cache[name]
+            file_remove(self.cache_path(name))
+
+        return [0, "Package stored"]
+
+    def materialise(self, name, pkg_path):
+        if not name_valid(name):
+            return [1, "Invalid package name"]
+
+        if not os.path.isfile(self.manifest_path(name)):
+            return [1, "Package not found"]
+
+        # Writing into the store would clobber the files being read
+        if self.in_store(pkg_path):
+            return [1, "Destination inside package store"]
+
+        m = self.read_manifest(name)
+        if m == None:
+            return [1, "Invalid package manifest"]
+        header = m[0]
+        digests = m[1]
+
+        # Cache hit, unless the cached file has gone missing or been damaged
+        cache_path = self.cache_path(name)
+        if name in self.cache:
+            if self.cache_valid(cache_path, header):
+                self.cache.move_to_end(name)
+                os.utime(cache_path)
+                try:
+                    self.link(cache_path, pkg_path)
+                except OSError:
+                    return [1, "Unable to write package file"]
+                return [0, "Package created"]
+            del self.cache[name]
+
+        envelopes = header_envelopes(header)
+        blob_paths = []
+        for i in range(len(envelopes)):
+            digest = digests[i*DIGEST_SIZE:(i+1)*DIGEST_SIZE]
+            blob_path = os.path.join(self.blob_dir, blob_name(digest, envelopes[i][2]))
+            if not os.path.isfile(blob_path):
+                return [1, "BLOB missing from store"]
+            blob_paths.append(blob_path)
+
+        # Without a cache, write straight to the destination
+        if self.cache_size < 1:
+            try:
+                self.build(header, blob_paths, [pkg_path])
+            except OSError:
+                return [1, "Unable to write package file"]
+            return [0, "Package created"]
+
+        # Write destination and cache entry in one pass
+        tmp_path = self.temp_path(self.cache_dir)
+        try:
+            self.build(header, blob_paths, [pkg_path, tmp_path])
+        except OSError:
+            file_remove(tmp_path)
+            return [1, "Unable to write package file"]
+        os.replace(tmp_path, cache_path)
+        self.cache[name] = True
+        self.cache_evict()
+        return [0, "Package created"]
+
+    def cache_valid(self, cache_path, header):
+        if not os.path.isfile(cache_path) or os.stat(cache_path).st_size != package_size(header):
+            return False
+        f = open(cache_path, "rb")
+        ba = f.read(len(header))
+        f.close()
+        return ba == header
+
+    def build(self, header, blob_paths, pkg_paths):
+        # Writes the package to each of pkg_paths, removing them on failure
+        dst = []
+        try:
+            for p in pkg_paths:
+                dst.append(open(p, "wb"))
+            for f in dst:
+                f.write(header)
+            for p in blob_paths:
+                src = open(p, "rb")
+                ba = src.read(CHUNK_SIZE)
+                while ba:
+                    for f in dst:
+                        f.write(ba)
+                    ba = src.read(CHUNK_SIZE)
+                src.close()
+            for f in dst:
+                f.close()
+        except OSError:
+            for i in range(len(dst)):
+                dst[i].close()
+                file_remove(pkg_paths[i])
+            raise
+
+    def link(self, cache_path, pkg_path):
+        # Hard link the cached package to the destination, or copy it where
+        # links are not supported (e.g. FAT or another drive)
+        tmp_path = pkg_path + "." + str(os.getpid()) + ".tmp"
+        try:
+            os.link(cache_path, tmp_path)
+            os.replace(tmp_path, pkg_path)
+            file_remove(tmp_path)
+            return
+        except OSError:
+            file_remove(tmp_path)
+
+        dst = open(pkg_path, "wb")
+        try:
+            file_concat(dst, cache_path)
+            dst.close()
+        except OSError:
+            dst.close()
+            file_remove(pkg_path)
+            raise
+
+    def cache_evict(self):
+        while len(self.cache) > max(self.cache_size, 0):
+            name = self.cache.popitem(last=False)[0]
+            file_remove(self.cache_path(name))
+
+def usage():
+    print("Usage:")
+    print("  python pkgstore.py <store> add [-replace] [-prefix <prefix>] <pkg file> [<pkg file> ...]")
+    print("  python pkgstore.py <store> add [-replace] -name <name> <pkg file>")
+    print("  python pkgstore.py <store> get <name> <pkg file>")
+    print("  python pkgstore.py <store> list")
+    quit()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        usage()
+
+    store = PkgStore(sys.argv[1])
+    cmd = sys.argv[2]
+
+    if cmd == "add":
+        replace = False
+        prefix = ""
+        name = None
+        files = []
+        i = 3
+        while i < len(sys.argv):
+            if sys.argv[i] == "-replace":
+                replace = True
+            elif sys.argv[i] == "-prefix" and len(sys.argv) > i+1:
+                prefix = sys.argv[i+1]
+                i += 1
+            elif sys.argv[i] == "-name" and len(sys.argv) > i+1:
+                name = sys.argv[i+1]
+                i += 1
+            else:
+                files.append(sys.argv[i])
+            i += 1
+
+        if len(files) == 0 or (name != None and len(files) > 1):
+            usage()
+
+        for p in files:
+            n = name
+            if n == None:
+                n = prefix + os.path.splitext(os.path.basename(p))[0]
+            r = store.ingest(p, n, replace)
+            print(p + " -> " + n + ": " + r[1])
+
+    elif cmd == "get" and len(sys.argv) == 5:
+        r = store.materialise(sys.argv[3], sys.argv[4])
+        print(r[1])
+
+    elif cmd == "list":
+        for name in store.list():
+            print(name)
+
+    else:
+        usage()